@@ -8,34 +8,141 @@ import pandas as pd
 import dash_bootstrap_components as dbc
 from covid19_util import *
 from covid19_processing import *
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import forecast
 from datetime import date
 import dash_table
 
-# get data from JHU
-data = Covid19Processing()
-data.process(rows=20, debug=False)
-data.list_countries()
+# get data from JHU, shared by all callbacks and refreshed in the background
+# set COVID19_OFFLINE to only use the local cache (or the COVID19_MIRROR directory)
+dataset = Covid19Dataset(offline = os.environ.get('COVID19_OFFLINE', None) is not None,
+                         mirror_dir = os.environ.get('COVID19_MIRROR', None))
+data = dataset.get()
 params = pd.read_csv("params.csv", sep = ";")
 
 # fit model to hospitalizations
 forecaster = forecast.forecast_covid19()
 forecaster.get_NICE_data()
-forecaster.fit_REIS(cutoff= 30, name = "outlook")
-forecaster.fit_REIS(cutoff= 30, name = "previous_forecast", days_back = 7)
-forecaster.fit_REIS(cutoff= 30, name = "3d_ago_forecast", days_back = 14)
+forecaster.fit_many([dict(cutoff= 30, name = "outlook"),
+                     dict(cutoff= 30, name = "previous_forecast", days_back = 7),
+                     dict(cutoff= 30, name = "3d_ago_forecast", days_back = 14)])
+
+# start refreshing the data in the background, after fit_many has forked its workers
+dataset.start()
+
+# confidence intervals of the fitted R factors, error bars in figure 3
+forecaster.profile_likelihood(cutoff= 30, name = "outlook")
+forecaster.profile_likelihood(cutoff= 30, name = "previous_forecast", days_back = 7)
+forecaster.profile_likelihood(cutoff= 30, name = "3d_ago_forecast", days_back = 14)
 
 # get betas from fitted model
 factors = forecaster.factors["outlook"]
 
-# get target R to stay below 1900 IC beds
+# get target R to stay below the IC capacity (ic_capacity beds)
 Rtarget = forecaster.determine_Rtarget(name = "outlook")
+if Rtarget is None:
+    # even R = 0 exceeds the IC capacity, start the slider at its minimum
+    print(f"No R keeps IC demand below {ic_capacity} beds")
+    Rtarget = 0
+
+# IC demand for every position of the R target slider
+forecaster.precompute_targets(name = "outlook")
 
 # set dates
 yesterday = str((date.today()-datetime.timedelta(days = 1)).strftime("%d/%m/%Y"))
 forecast_day = forecaster.hospitals.iloc[-1,0]
 
+# figure 4: IC demand forecast, R is the target from the slider
+def create_outlook_figure(R):
+    #TO DO: integrate most of this into forecaster class
+    # get fitted model
+    solution_outlook =  forecaster.forecasts["outlook"]
+    solution_prev = forecaster.forecasts["previous_forecast"]
+    solution_3d = forecaster.forecasts["3d_ago_forecast"]
+    y_ic_target = forecaster.target_ic(R, name = "outlook")
+
+    # create data sets for figures with outlook IC utilization
+    y_ic_outlook = solution_outlook.ic_load
+    y_ic_previous = solution_prev.ic_load
+    y_ic_3d = solution_3d.ic_load
+    ic_cap = np.ones(len(y_ic_outlook))*ic_capacity
+    ic_min = np.ones(len(y_ic_outlook))*700
+    x_outlook = pd.date_range(start=model_start, periods=len(y_ic_outlook))
+
+    # create figure
+    outlook_fig = go.Figure()
+    outlook_fig.add_trace(go.Scatter(y=y_ic_3d,
+                                     x= x_outlook,
+                                     name = "Forecast 2 weeks ago",
+                                     line = dict(color='#e0e0e0', width=2),
+                                     hovertemplate = '%{x}, '+'%{y:.0f}'))
+    outlook_fig.add_trace(go.Scatter(y=y_ic_previous,
+                                     x= x_outlook,
+                                     name = "Forecast last week",
+                                     line = dict(color='#bfbfbf', width=2),
+                                     hovertemplate = '%{x}, '+'%{y:.0f}'))
+    outlook_fig.add_trace(go.Scatter(y=y_ic_outlook,
+                                     x= x_outlook,
+                                     name = "Latest forecast",
+                                     line = dict(color = '#949494'),
+                                     hovertemplate = '%{x}, '+'%{y:.0f}'))
+    outlook_fig.add_trace(go.Scatter(y=y_ic_target,
+                                     x= x_outlook,
+                                     name = "R Target",
+                                     line = dict(color = 'green'),
+                                     hovertemplate = '%{x}, '+'%{y:.0f}'))
+    outlook_fig.add_trace(go.Scatter(
+                                    y=forecaster.ic_actuals,
+                                    x= x_outlook,
+                                    name = "Actual (COVID) IC patients",
+                                    line = dict(color='black', width=2),
+                                    mode = 'markers',
+                                    hovertemplate = '%{x}, '+'%{y:.0f}'))
+    outlook_fig.add_trace(go.Scatter(
+                                y=ic_cap,
+                                x= x_outlook,
+                                name = "ic capacity",
+                                line = dict(color='#E21F35', width=2, dash ="dot"),
+                                showlegend=False,
+                                hovertemplate = '%{x}, '+'%{y:.0f}'))
+    outlook_fig.add_trace(go.Scatter(
+                                y=ic_min,
+                                x= x_outlook,
+                                name = "short term objective",
+                                line = dict(color='green', width=2, dash ="dot"),
+                                showlegend=False,
+                                hovertemplate = '%{x}, '+'%{y:.0f}'))
+    outlook_fig.add_annotation(annotation_layout,
+                               x=(date.today()-datetime.timedelta(days = 50)),
+                               y=ic_capacity - 30,
+                               text="Max IC capacity")
+    outlook_fig.add_annotation(annotation_layout,
+                               x=(date.today()+datetime.timedelta(days = 10)),
+                               y=700,
+                               text="Normalized IC occupation")
+
+    # format figure
+    outlook_fig.update_layout(
+        graph_layout,
+        plot_bgcolor='white',
+        xaxis_title="Days",
+        title = dict(text="Figure 4: Forecast of demand for IC care",
+                     font=title_font)
+            )
+    outlook_fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='LightGrey')
+    outlook_fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='LightGrey')
+    return outlook_fig
+
+# render figure 3 and 4 in the browser when the R target slider moves (COVID19_CLIENTSIDE set):
+# the IC demand for every slider position is shipped once, with the page
+clientside_sliders = os.environ.get('COVID19_CLIENTSIDE', None) is not None
+slider_store = None
+if clientside_sliders:
+    slider_store = {"payload": forecaster.slider_payload(name = "outlook"),
+                    "bar": forecaster.create_bar(Rtarget = Rtarget).to_dict(),
+                    "outlook": create_outlook_figure(Rtarget).to_dict(),
+                    "trace": 3} # index of the R target trace in figure 4
+
 ## dash app
 # App definition and authorisation
 app = dash.Dash(__name__,
@@ -127,6 +234,7 @@ html.Div([navbar,
         Figure 3 shows our model’s estimate of the reproduction rate during both periods. Figure 4 shows our model’s projection for the corresponding IC demand. Both graphs show our estimate for today and our estimates from the last two weeks. The latest forecast is based on hospitalizations up until 5 days ago, as it takes a while for hospitals to report.
         '''),
         dcc.Graph(id = 'outlook_figure', className="m3-graph"),
+        dcc.Store(id = 'slider_store', data = slider_store),
         dcc.Markdown('''
         Time-lag plays an important role in projecting demand for IC beds. The effects of the NL measures did not have an immediate impact on hospitalisation and IC rates. It takes roughly 2 weeks from initial infection to needing IC care and 3 weeks after that before the IC bed is released.  Because of this, current numbers still include patients which were infected before measures were implemented. As a result, our estimates of R and corresponding IC demand still change daily as the share of patients infected before the NL measures declines.
 
@@ -248,113 +356,41 @@ app.layout = html.Div(
     Output('deaths', 'figure'),
     [Input('country_dropdown', 'value')])
 def update_figure3(options):
-    data = Covid19Processing()
-    data.process(rows=20, debug=False)
-    data.list_countries()
-    return data.create_growth_figures("deaths",options)
+    return dataset.get().create_growth_figures("deaths",options)
 
 # callback for adding countries to figure 2
 @app.callback(
     Output('growth', 'figure'),
     [Input('country_dropdown', 'value')])
 def update_figure4(options):
-    data = Covid19Processing()
-    data.process(rows=20, debug=False)
-    data.list_countries()
-    return data.create_factor_figure(options)
-
-# interaction for figure 3 with slider
-@app.callback(
-    Output('R0_bar', 'figure'),
-    [Input('I1_slider', 'value')])
-def update_figure2(R):
-    return forecaster.create_bar(Rtarget = R)
-
-# interaction for figure 4 with slider
-@app.callback(
-    Output('outlook_figure', 'figure'),
-    [Input('I1_slider', 'value')])
-def update_figure1(R):
-    #TO DO: integrate most of this into forecaster class
-    # get fitted model
-    solution_outlook =  forecaster.forecasts["outlook"]
-    solution_prev = forecaster.forecasts["previous_forecast"]
-    solution_3d = forecaster.forecasts["3d_ago_forecast"]
-    solution_target = forecaster.SEIR_solution(intervention = [(30,factors[0]),
-                                                               (300,R/2.2)])
+    return dataset.get().create_factor_figure(options)
+
+# interaction for figure 3 and 4 with slider
+if clientside_sliders:
+    # redrawn in the browser from slider_store, see assets/sliders.js
+    app.clientside_callback(
+        ClientsideFunction(namespace = 'sliders', function_name = 'update_bar'),
+        Output('R0_bar', 'figure'),
+        [Input('I1_slider', 'value')],
+        [State('slider_store', 'data')])
+    app.clientside_callback(
+        ClientsideFunction(namespace = 'sliders', function_name = 'update_outlook'),
+        Output('outlook_figure', 'figure'),
+        [Input('I1_slider', 'value')],
+        [State('slider_store', 'data')])
+else:
+    @app.callback(
+        Output('R0_bar', 'figure'),
+        [Input('I1_slider', 'value')])
+    def update_figure2(R):
+        return forecaster.create_bar(Rtarget = R)
+
+    @app.callback(
+        Output('outlook_figure', 'figure'),
+        [Input('I1_slider', 'value')])
+    def update_figure1(R):
+        return create_outlook_figure(R)
 
-    # create data sets for figures with outlook IC utilization
-    y_ic_outlook = solution_outlook["I_ic"] + solution_outlook["I_fatal"] * 0.5
-    y_ic_target = solution_target["I_ic"] + solution_target["I_fatal"] * 0.5
-    y_ic_previous = solution_prev["I_ic"] + solution_prev["I_fatal"] * 0.5
-    y_ic_3d = solution_3d["I_ic"] + solution_3d["I_fatal"] * 0.5
-    ic_cap = np.ones(len(y_ic_outlook))*1900
-    ic_min = np.ones(len(y_ic_outlook))*700
-    x_outlook = pd.date_range(start='16/2/2020', periods=len(y_ic_outlook))
-
-    # create figure
-    outlook_fig = go.Figure()
-    outlook_fig.add_trace(go.Scatter(y=y_ic_3d,
-                                     x= x_outlook,
-                                     name = "Forecast 2 weeks ago",
-                                     line = dict(color='#e0e0e0', width=2),
-                                     hovertemplate = '%{x}, '+'%{y:.0f}'))
-    outlook_fig.add_trace(go.Scatter(y=y_ic_previous,
-                                     x= x_outlook,
-                                     name = "Forecast last week",
-                                     line = dict(color='#bfbfbf', width=2),
-                                     hovertemplate = '%{x}, '+'%{y:.0f}'))
-    outlook_fig.add_trace(go.Scatter(y=y_ic_outlook,
-                                     x= x_outlook,
-                                     name = "Latest forecast",
-                                     line = dict(color = '#949494'),
-                                     hovertemplate = '%{x}, '+'%{y:.0f}'))
-    outlook_fig.add_trace(go.Scatter(y=y_ic_target,
-                                     x= x_outlook,
-                                     name = "R Target",
-                                     line = dict(color = 'green'),
-                                     hovertemplate = '%{x}, '+'%{y:.0f}'))
-    outlook_fig.add_trace(go.Scatter(
-                                    y=forecaster.ic_actuals,
-                                    x= x_outlook,
-                                    name = "Actual (COVID) IC patients",
-                                    line = dict(color='black', width=2),
-                                    mode = 'markers',
-                                    hovertemplate = '%{x}, '+'%{y:.0f}'))
-    outlook_fig.add_trace(go.Scatter(
-                                y=ic_cap,
-                                x= x_outlook,
-                                name = "ic capacity",
-                                line = dict(color='#E21F35', width=2, dash ="dot"),
-                                showlegend=False,
-                                hovertemplate = '%{x}, '+'%{y:.0f}'))
-    outlook_fig.add_trace(go.Scatter(
-                                y=ic_min,
-                                x= x_outlook,
-                                name = "short term objective",
-                                line = dict(color='green', width=2, dash ="dot"),
-                                showlegend=False,
-                                hovertemplate = '%{x}, '+'%{y:.0f}'))
-    outlook_fig.add_annotation(annotation_layout,
-                               x=(date.today()-datetime.timedelta(days = 50)),
-                               y=1870,
-                               text="Max IC capacity")
-    outlook_fig.add_annotation(annotation_layout,
-                               x=(date.today()+datetime.timedelta(days = 10)),
-                               y=700,
-                               text="Normalized IC occupation")
-
-    # format figure
-    outlook_fig.update_layout(
-        graph_layout,
-        plot_bgcolor='white',
-        xaxis_title="Days",
-        title = dict(text="Figure 4: Forecast of demand for IC care",
-                     font=title_font)
-            )
-    outlook_fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='LightGrey')
-    outlook_fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='LightGrey')
-    return outlook_fig
 
 # interaction for figure 5 with sliders
 @app.callback(
@@ -376,15 +412,8 @@ def update_figure1(measures, R, days, inc, IC):
                                 days = days,
                                 t_inc = inc,
                                 t_ic = IC)
-    solution_outlook["IC_total"] = solution_outlook["I_ic"] + \
-                                    solution_outlook["I_fatal"] * 0.5
-    solution_outlook["R_total"] = solution_outlook["R_mild"] +\
-                                    solution_outlook["R_hosp"]  +\
-                                    solution_outlook["R_ic"]
-    solution_outlook["Hosp_tot"] = solution_outlook["I_ic"] +\
-                                    solution_outlook["I_hosp"] +\
-                                    solution_outlook["I_fatal"]
-    x_outlook = pd.date_range(start='16/2/2020',
+    # Hosp_tot, IC_total and R_total are aggregates of the result, see forecast.SEIR_result
+    x_outlook = pd.date_range(start=model_start,
                               periods=len(solution_outlook))
 
     # create figure
@@ -0,0 +1,44 @@
+// Clientside rendering of Figure 3 and 4 for the R target slider, used when app.py runs
+// with COVID19_CLIENTSIDE set. slider_store holds the figures as rendered for the initial
+// R target and the IC demand curve for every slider position (forecaster.slider_payload).
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    sliders: {
+        // base64 float32 matrix (R x days) -> Float32Array, decoded once per page load
+        decode: function(payload) {
+            if (payload._ic === undefined) {
+                var bytes = atob(payload.ic);
+                var buffer = new ArrayBuffer(bytes.length);
+                var view = new Uint8Array(buffer);
+                for (var i = 0; i < bytes.length; i++) {
+                    view[i] = bytes.charCodeAt(i);
+                }
+                payload._ic = new Float32Array(buffer);
+            }
+            return payload._ic;
+        },
+
+        update_bar: function(R, store) {
+            var base = store.bar;
+            var trace = Object.assign({}, base.data[0]);
+            trace.y = trace.y.slice();
+            trace.text = trace.text.slice();
+            trace.y[trace.y.length - 1] = R;
+            trace.text[trace.text.length - 1] = R;
+            return Object.assign({}, base, {data: [trace]});
+        },
+
+        update_outlook: function(R, store) {
+            var payload = store.payload;
+            var ic = window.dash_clientside.sliders.decode(payload);
+            var pos = Math.round((R - payload.R[0]) / payload.step);
+            pos = Math.min(Math.max(pos, 0), payload.R.length - 1);
+
+            var base = store.outlook;
+            var data = base.data.slice();
+            data[store.trace] = Object.assign({}, data[store.trace], {
+                y: ic.subarray(pos * payload.days, (pos + 1) * payload.days)
+            });
+            return Object.assign({}, base, {data: data});
+        }
+    }
+});
@@ -0,0 +1,179 @@
+# Retrieval of the raw JHU time series, with a local on-disk cache
+
+import os
+import json
+import time
+import hashlib
+import threading
+import http.server
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from covid19_util import *
+
+
+class DownloadCache:
+    # Every downloaded CSV is kept in cache_dir, next to a small .json file holding the
+    # ETag / Last-Modified headers of the response. Requests are made conditional on
+    # those headers, so an unchanged file costs a 304 and a file read.
+    # When GitHub cannot be reached the cached copy is served, however old it is.
+    # In offline mode no request is made at all: files come from mirror_dir or the cache.
+    def __init__(self, cache_dir=cache_dir, offline=False, mirror_dir=None, timeout=request_timeout):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.mirror_dir = mirror_dir
+        self.timeout = timeout
+        self.status = {}  # url -> how it was last served, for debugging
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def paths(self, url):
+        # prefix with a hash of the url so different branches don't share a file
+        name = os.path.basename(url)
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:10]
+        path = os.path.join(self.cache_dir, f"{key}_{name}")
+        return path, path + ".json"
+
+    def get(self, url, session=None):
+        path, meta_path = self.paths(url)
+        if self.offline:
+            return self._get_offline(url, path)
+
+        meta = {}
+        if os.path.exists(path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        headers = {}
+        if "etag" in meta:
+            headers["If-None-Match"] = meta["etag"]
+        if "last_modified" in meta:
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            r = (session or requests).get(url, headers=headers, timeout=self.timeout)
+            if r.status_code == 304:
+                self.status[url] = "not modified"
+                return self._read(path)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            if not os.path.exists(path):
+                raise
+            # network down or server error: serve the stale copy
+            print(f"Could not retrieve {url} ({e}), using cached copy")
+            self.status[url] = "stale"
+            return self._read(path)
+
+        self._write(path, r.text)
+        meta = {"url": url}
+        if "ETag" in r.headers:
+            meta["etag"] = r.headers["ETag"]
+        if "Last-Modified" in r.headers:
+            meta["last_modified"] = r.headers["Last-Modified"]
+        self._write(meta_path, json.dumps(meta))
+        self.status[url] = "downloaded"
+        return r.text
+
+    def _get_offline(self, url, path):
+        if self.mirror_dir is not None:
+            mirror_path = os.path.join(self.mirror_dir, os.path.basename(url))
+            if os.path.exists(mirror_path):
+                self.status[url] = "mirror"
+                return self._read(mirror_path)
+        if os.path.exists(path):
+            self.status[url] = "cache"
+            return self._read(path)
+        raise FileNotFoundError(f"Offline mode: no cached or mirrored copy of {url}")
+
+    def _read(self, path):
+        with open(path, encoding="utf-8", newline="") as f:
+            return f.read()
+
+    def _write(self, path, text):
+        with atomic_write(path) as tmp_path:
+            with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+                f.write(text)
+
+
+def create_session(retries=request_retries, pool_size=10):
+    # One session per process: connections to GitHub are kept alive and reused.
+    # Failed connects and 5xx responses are retried with exponential backoff.
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_all(urls, cache, session=None, max_workers=None):
+    # Retrieve all urls concurrently.
+    # urls is a dict name -> url, the result a dict name -> text.
+    # Wall time is bounded by the slowest file instead of the sum of all files.
+    if session is None:
+        session = create_session(pool_size=len(urls))
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(urls)) as pool:
+        futures = {name: pool.submit(cache.get, url, session=session) for name, url in urls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+class _MirrorHandler(http.server.SimpleHTTPRequestHandler):
+    delay = 0
+
+    def etag(self, path):
+        st = os.stat(path)
+        return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        path = self.translate_path(self.path)
+        if os.path.isfile(path) and self.headers.get("If-None-Match") == self.etag(path):
+            self.send_response(304)
+            self.send_header("ETag", self.etag(path))
+            self.end_headers()
+            return
+        super().do_GET()
+
+    def end_headers(self):
+        path = self.translate_path(self.path)
+        if os.path.isfile(path):
+            self.send_header("ETag", self.etag(path))
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MirrorServer:
+    # Local HTTP stand-in for raw.githubusercontent.com, serving the CSVs in directory.
+    # Supports ETag and Last-Modified revalidation; delay (seconds) simulates a slow link.
+    # Use as Covid19Processing(base_url=server.base_url) to exercise the online path offline.
+    def __init__(self, directory, port=0, delay=0):
+        handler = type("Handler", (_MirrorHandler,), {"delay": delay})
+        self.httpd = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", port), lambda *args: handler(*args, directory=directory))
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    # python covid19_download.py <directory> [port]
+    import sys
+    server = MirrorServer(sys.argv[1], port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
+    print(f"Serving {sys.argv[1]} at {server.base_url}")
+    server.httpd.serve_forever()
@@ -1,7 +1,7 @@
 from covid19_util import *
+from covid19_download import DownloadCache, fetch_all, create_session
 from matplotlib import dates as mdates
 import pandas as pd
-import requests
 import scipy.optimize
 import scipy.stats
 from io import StringIO
@@ -9,13 +9,181 @@ import datetime
 import geonamescache
 import plotly.graph_objs as go
 import math
+import os
+import csv
+import json
+import shutil
+import hashlib
+import threading
+import time
+import copy
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import scipy.ndimage
 from scipy.integrate import odeint
 
 
+class TimeSeriesStore:
+    # Compact storage of the processed time series: one contiguous int32 matrix
+    # (regions x dates) per metric. All metrics share the region index (countries first,
+    # then continents) and one date index; spans[metric] is the (start, stop) slice of the
+    # date index a metric covers, as confirmed starts a few days before deaths.
+    # Rows, columns and DataFrames handed out are views on the matrices, not copies.
+    def __init__(self, regions, n_countries, dates):
+        self.regions = pd.Index(regions)
+        self.n_countries = n_countries
+        self.dates = pd.DatetimeIndex(dates)
+        self.matrices = {}
+        self.spans = {}
+
+    @classmethod
+    def from_frames(cls, frames):
+        # frames: metric -> (by_country, by_continent)
+        by_country, by_continent = next(iter(frames.values()))
+        regions = list(by_country.index) + list(by_continent.index)
+        dates = sorted(set().union(*[set(c.columns) for c, _ in frames.values()]))
+        store = cls(regions, len(by_country.index), dates)
+        for metric, (by_country, by_continent) in frames.items():
+            df = pd.concat([by_country, by_continent]).reindex(store.regions, fill_value=0)
+            store.add(metric, df.values, df.columns)
+        return store
+
+    def add(self, metric, matrix, dates):
+        # rows of matrix follow self.regions, dates must be a consecutive run of self.dates
+        start = self.dates.get_loc(dates[0])
+        stop = start + len(dates)
+        if not self.dates[start:stop].equals(pd.DatetimeIndex(dates)):
+            raise ValueError(f"Dates of {metric} do not match the date index")
+        self.matrices[metric] = np.ascontiguousarray(matrix, dtype=np.int32)
+        self.spans[metric] = (start, stop)
+
+    def extend(self, columns):
+        # A new store with the columns of new dates appended. columns is metric -> (matrix, dates),
+        # the dates of a metric must follow its last date. This store is left as it is, so
+        # readers of it never see dates, matrices and spans out of step.
+        dates = self.dates
+        for matrix, new_dates in columns.values():
+            new_dates = pd.DatetimeIndex(new_dates)
+            dates = dates.append(new_dates[~new_dates.isin(dates)])
+        store = TimeSeriesStore(self.regions, self.n_countries, dates)
+        store.matrices = dict(self.matrices)
+        store.spans = dict(self.spans)
+        for metric, (matrix, new_dates) in columns.items():
+            start, stop = self.spans[metric]
+            new_dates = pd.DatetimeIndex(new_dates)
+            if not dates[stop:stop + len(new_dates)].equals(new_dates):
+                raise ValueError(f"Dates of {metric} do not follow its last date")
+            store.matrices[metric] = np.concatenate([self.matrices[metric], matrix.astype(np.int32)], axis=1)
+            store.spans[metric] = (start, stop + len(new_dates))
+        return store
+
+    def dates_of(self, metric):
+        start, stop = self.spans[metric]
+        return self.dates[start:stop]
+
+    def row(self, metric, region):
+        return self.matrices[metric][self.regions.get_loc(region)]
+
+    def column(self, metric, date):
+        return self.matrices[metric][:, self.dates.get_loc(date) - self.spans[metric][0]]
+
+    def frame(self, metric, rows=slice(None)):
+        return pd.DataFrame(self.matrices[metric][rows], index=self.regions[rows],
+                            columns=self.dates_of(metric), copy=False)
+
+    def countries(self, metric):
+        return self.frame(metric, slice(0, self.n_countries))
+
+    def continents(self, metric):
+        return self.frame(metric, slice(self.n_countries, None))
+
+    def nbytes(self):
+        return sum(matrix.nbytes for matrix in self.matrices.values())
+
+
+class DerivedMetrics:
+    # The series of get_new_cases_details (new deaths, growth factor, moving average and
+    # its median filtered growth) for all regions of a store in one pass.
+    # As in get_new_cases_details, only days with more than one new death are kept. Those
+    # days are packed to the left of each row, so the filters run along the date axis of a
+    # single (regions x days) matrix. Rows are padded to the right the way scipy.ndimage pads
+    # a single series (reflect for the average, nearest for the median), so a row gives the
+    # same new_deaths, growth_factor and filtered_new_deaths as that country on its own. The
+    # filtered_growth_factor differs on its first two days, see the median filter below.
+    columns = ["confirmed_deaths", "new_deaths", "growth_factor",
+               "filtered_new_deaths", "filtered_growth_factor"]
+
+    def __init__(self, store, metric="deaths", avg_n=7, median_n=3):
+        self.regions = store.regions
+        self.dates = store.dates_of(metric)
+        totals = store.matrices[metric]
+
+        new = np.full(totals.shape, np.nan)
+        new[:, 1:] = np.maximum(0, np.diff(totals, axis=1))
+        keep = new > 1
+        self.lengths = keep.sum(axis=1)
+        width = max(self.lengths.max(), 1)
+
+        # stable sort moves the kept days to the front, in date order
+        order = np.argsort(~keep, axis=1, kind="stable")[:, :width]
+        valid = np.arange(width)[None, :] < self.lengths[:, None]
+        self.positions = np.where(valid, order, -1)
+        self.confirmed_deaths = np.where(valid, np.take_along_axis(totals, order, axis=1), 0)
+        self.new_deaths = np.where(valid, np.take_along_axis(new, order, axis=1), np.nan)
+
+        self.growth_factor = self.growth(self.new_deaths)
+        self.growth_factor[~np.isfinite(self.growth_factor)] = np.nan
+
+        padded = self.pad(self.new_deaths, width + avg_n, "reflect")
+        self.filtered_new_deaths = scipy.ndimage.convolve(padded, np.ones((1, avg_n)) / avg_n,
+                                                          origin=(0, -avg_n // 2 + 1))[:, :width]
+        self.filtered_growth_factor = self.growth(self.filtered_new_deaths)
+        # The first day has no growth factor. Where a NaN ends up in a median depends on the
+        # scipy version, so the filter sees the nearest defined value (as its own "nearest"
+        # mode would) and the first day is set back to NaN afterwards. This is where we differ
+        # from filtering a single series: the first day is always NaN, and the second day's
+        # median (with median_n=3) takes the first defined value twice instead of a NaN.
+        if width > 1:
+            self.filtered_growth_factor[:, 0] = self.filtered_growth_factor[:, 1]
+        padded = self.pad(self.filtered_growth_factor, width + median_n, "nearest")
+        self.filtered_growth_factor = scipy.ndimage.median_filter(padded, size=(1, median_n),
+                                                                  mode="nearest")[:, :width]
+        self.filtered_growth_factor[:, 0] = np.nan
+        for column in self.columns[1:]:
+            getattr(self, column)[~valid] = np.nan
+
+    def growth(self, x):
+        # x.diff() / x.shift(1) + 1 along the rows
+        g = np.full(x.shape, np.nan)
+        g[:, 1:] = (x[:, 1:] - x[:, :-1]) / x[:, :-1] + 1
+        return g
+
+    def pad(self, x, width, mode):
+        # extend every row beyond its own length as scipy.ndimage would extend the row on its own
+        j = np.arange(width)[None, :]
+        n = np.maximum(self.lengths, 1)[:, None]
+        if mode == "reflect":
+            j = j % (2 * n)
+            j = np.where(j >= n, 2 * n - 1 - j, j)
+        else:
+            j = np.minimum(j, n - 1)
+        return np.take_along_axis(x, j, axis=1)
+
+    def details(self, region):
+        # same frame as get_new_cases_details(region)
+        r = self.regions.get_loc(region)
+        n = self.lengths[r]
+        return pd.DataFrame({column: getattr(self, column)[r, :n] for column in self.columns},
+                            index=self.dates[self.positions[r, :n]])
+
+
 class Covid19Processing:
-    def __init__(self):
+    def __init__(self, offline=False, mirror_dir=None, cache_dir=cache_dir, base_url=base_url, session=None):
         self.dataframes = {}
+        self.store = None
+        self.version = 0  # bumped whenever the processed data changes
+        self.derived = {}  # (avg_n, median_n) -> (version, DerivedMetrics)
+        self.country_data_cache = LRUCache(maxsize=country_data_cache_size)
         gc = geonamescache.GeonamesCache()
         gc_data = gc.get_countries()
         self.country_metadata = {}
@@ -42,12 +210,95 @@ class Covid19Processing:
                 "continent": continent
             }
 
+        # Retrieve all metrics concurrently (from URL or cache).
+        # Raw CSVs are cached on disk, see covid19_download.py
+        self.cache_dir = cache_dir
+        self.cache = DownloadCache(cache_dir, offline=offline, mirror_dir=mirror_dir)
+        self.session = session
+        self.urls = {metric: base_url + data_urls[metric] for metric in data_urls.keys()}  # Combine URL parts
+        self.sources = fetch_all(self.urls, self.cache, session=session)
+        self.fingerprint = self.source_fingerprint()
+
+        # Convert into Pandas dataframes, unless process() can load the snapshot instead
+        if not os.path.exists(self.snapshot_path()):
+            self.parse_sources()
+
+    def copy(self):
+        # Shallow copy with its own mutable state, to update() while readers use this instance
+        data = copy.copy(self)
+        data.dataframes = dict(self.dataframes)
+        data.derived = dict(self.derived)
+        data.sources = dict(self.sources)
+        data.country_data_cache = LRUCache(maxsize=country_data_cache_size)
+        return data
+
+    def source_fingerprint(self):
+        # Identifies the source data, a processed snapshot is only reused for identical input
+        fingerprint = hashlib.sha1(f"snapshot format {snapshot_format}".encode("utf-8"))
         for metric in data_urls.keys():
-            url = base_url + data_urls[metric]  # Combine URL parts
-            r = requests.get(url)  # Retrieve from URL
-            self.dataframes[metric] = pd.read_csv(StringIO(r.text), sep=",")  # Convert into Pandas dataframe
+            fingerprint.update(metric.encode("utf-8"))
+            fingerprint.update(self.sources[metric].encode("utf-8"))
+        return fingerprint.hexdigest()[:16]
+
+    def parse_sources(self):
+        with ThreadPoolExecutor(max_workers=len(data_urls)) as pool:
+            frames = pool.map(lambda text: pd.read_csv(StringIO(text), sep=","),
+                              [self.sources[metric] for metric in data_urls.keys()])
+            self.dataframes.update(zip(data_urls.keys(), frames))
+
+    def snapshot_path(self):
+        return os.path.join(self.cache_dir, "snapshot_" + self.fingerprint)
+
+    def save_snapshot(self):
+        # Store the matrices of the store as one .npy file per metric, plus a json file
+        # with the regions and dates, in one directory (see atomic_write)
+        path = self.snapshot_path()
+        with atomic_write(path) as tmp_path:
+            os.makedirs(tmp_path)
+            for metric, matrix in self.store.matrices.items():
+                np.save(os.path.join(tmp_path, metric + ".npy"), matrix)
+            index = {"regions": list(self.store.regions),
+                     "n_countries": self.store.n_countries,
+                     "dates": [d.strftime("%Y-%m-%d") for d in self.store.dates],
+                     "spans": self.store.spans}
+            with open(os.path.join(tmp_path, "index.json"), "w") as f:
+                json.dump(index, f)
+
+        # clean up snapshots of older data
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("snapshot_") and name != os.path.basename(path) and not name.endswith(".tmp"):
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+    def load_snapshot(self):
+        # Memory-map the matrices of a snapshot made from the same source data.
+        # Returns False when there is none. Workers loading the same snapshot share its pages.
+        path = self.snapshot_path()
+        if not os.path.exists(path):
+            return False
+        with open(os.path.join(path, "index.json")) as f:
+            index = json.load(f)
+        store = TimeSeriesStore(index["regions"], index["n_countries"], pd.to_datetime(index["dates"]))
+        for metric, (start, stop) in index["spans"].items():
+            matrix = np.load(os.path.join(path, metric + ".npy"), mmap_mode="r")
+            store.add(metric, matrix, store.dates[start:stop])
+        self.set_store(store)
+        return True
+
+    def set_store(self, store):
+        # the processed frames are DataFrame views on the store
+        self.store = store
+        self.version += 1
+        self.country_data_cache.clear()
+        for metric in store.matrices:
+            self.dataframes[metric + "_by_country"] = store.countries(metric)
+            self.dataframes[metric + "_by_continent"] = store.continents(metric)
+
+    def process(self, rows=20, debug=False, use_snapshot=True):
+        if use_snapshot and self.load_snapshot():
+            return
+        if any(metric not in self.dataframes for metric in data_urls.keys()):
+            self.parse_sources()
 
-    def process(self, rows=20, debug=False):
         # Clean up
         for metric in data_urls.keys():
             by_country = self.dataframes[metric].groupby("Country/Region").sum()  # Group by country
@@ -80,22 +331,7 @@ class Covid19Processing:
                 by_country.loc["Japan", pd.to_datetime("2/06/20")] = 23.5
 
             # Change some weird formal names to more commonly used ones
-            by_country = by_country.rename(index={"Republic of Korea": "South Korea",
-                                                  "Holy See": "Vatican City",
-                                                  "Iran (Islamic Republic of)": "Iran",
-                                                  "Viet Nam": "Vietnam",
-                                                  "Taipei and environs": "Taiwan",
-                                                  "Republic of Moldova": "Moldova",
-                                                  "Russian Federaration": "Russia",
-                                                  "Korea, South": "South Korea",
-                                                  "Taiwan*": "Taiwan",
-                                                  "occupied Palestinian territory": "Palestine",
-                                                  "Bahamas, The": "Bahamas",
-                                                  "Cote d'Ivoire": "Ivory Coast",
-                                                  "Gambia, The": "Gambia",
-                                                  "US": "United States",
-                                                  "Cabo Verde": "Cape Verde",
-                                                  })
+            by_country = by_country.rename(index=country_renames)
             by_country.sort_index(inplace=True)
 
             # Store processed results for metric
@@ -104,56 +340,119 @@ class Covid19Processing:
 
         # Add in continents
         for metric in list(data_urls.keys()):
-            continent_data = {}
             by_country = self.dataframes[metric+"_by_country"]
-            for country in by_country.index:
-                if country in self.country_metadata:
-                    continent = self.country_metadata[country]["continent"]
-                    if continent in continent_data:
-                        continent_data[continent] += by_country.loc[country, :]
-                    else:
-                        continent_data[continent] = by_country.loc[country, :]
+            self.dataframes[metric + "_by_continent"] = self.continent_frame(metric, by_country, dates, debug)
+
+        # Move everything into the compact store
+        self.set_store(TimeSeriesStore.from_frames({metric: (self.dataframes[metric + "_by_country"],
+                                                             self.dataframes[metric + "_by_continent"])
+                                                    for metric in data_urls.keys()}))
+
+        if use_snapshot:
+            try:
+                self.save_snapshot()
+            except OSError as e:
+                print(f"Could not save snapshot: {e}")
+
+
+    def continent_frame(self, metric, by_country, dates, debug=False):
+        # Map every country to its continent and sum in a single groupby.
+        # Countries without metadata map to NaN and are left out.
+        continent_of = {country: metadata["continent"] for country, metadata in self.country_metadata.items()}
+        continents = by_country.index.map(continent_of)
+        if metric == "confirmed" and debug:
+            for country in by_country.index[continents.isna()]:
+                print(f"Missing metadata for {country}!")
+        by_continent = by_country.groupby(continents, sort=False).sum()
+
+        # Add in special regions
+        all_countries = by_country.sum()
+        special = pd.DataFrame([all_countries - by_country.loc["China", dates], all_countries],
+                               index=["All except China", "World"])
+        return pd.concat([by_continent, special]).fillna(0).astype(int)
+
+    def update(self, debug=False):
+        # Incremental refresh: re-fetch the sources and only parse, aggregate and append
+        # the date columns that are new since the last process() / update().
+        # Returns the number of new days. Falls back to a full process() when there is no
+        # processed state yet or the set of countries changed. Revisions JHU makes to days
+        # already ingested are only picked up by a full process(), so no snapshot is saved
+        # here: a snapshot always holds what process() makes of its sources.
+        # The store is replaced in one step at the end; when the update fails the current
+        # data is kept as it was. Use it on a copy() of an instance others are reading.
+        if self.store is None:
+            self.process(debug=debug)
+            return len(self.store.dates)
+
+        self.sources = fetch_all(self.urls, self.cache, session=self.session)
+        self.fingerprint = self.source_fingerprint()
+        for metric in data_urls.keys():
+            self.dataframes.pop(metric, None)  # parsed from the previous sources
 
-                elif metric == "confirmed" and debug:
-                    print(f"Missing metadata for {country}!")
+        new_frames = {}
+        for metric in data_urls.keys():
+            text = self.sources[metric]
+            header = next(csv.reader(StringIO(text.split("\n", 1)[0])))
+            known = self.store.dates_of(metric)
+            new_columns = [c for c in header[4:] if pd.to_datetime(c) not in known]  # Skip Province/Country/Lat/Long
 
-            by_continent = pd.DataFrame(columns=by_country.columns)
-            for continent in continent_data:
-                by_continent.loc[continent, :] = continent_data[continent]
+            # Only parse and aggregate the new columns (and the countries, also without new days)
+            new_data = pd.read_csv(StringIO(text), sep=",", usecols=["Country/Region"] + new_columns)
+            by_country = new_data.groupby("Country/Region").sum()
+            by_country.columns = pd.to_datetime(by_country.columns)
+            by_country = by_country.rename(index=country_renames)
+            by_country.sort_index(inplace=True)
+            by_country = by_country.fillna(0).astype(int)
+            if not by_country.index.equals(self.store.regions[:self.store.n_countries]):
+                # countries were added or renamed, start over
+                self.process(debug=debug)
+                return max(len(new_columns), 1)
+            if new_columns:
+                new_frames[metric] = by_country
 
-            # Add in special regions
-            all_countries = by_country.sum()
-            by_continent.loc["All except China", :] = all_countries - by_country.loc["China", dates]
-            by_continent.loc["World", :] = all_countries
-            by_continent = by_continent
-            self.dataframes[metric + "_by_continent"] = by_continent.fillna(0).astype(int)
+        columns = {}
+        for metric, by_country in new_frames.items():
+            by_continent = self.continent_frame(metric, by_country, by_country.columns, debug)
+            new = pd.concat([by_country, by_continent]).reindex(self.store.regions, fill_value=0)
+            columns[metric] = (new.values, new.columns)
 
+        if columns:
+            self.set_store(self.store.extend(columns))
+        return max([len(df.columns) for df in new_frames.values()], default=0)
 
     def get_country_data(self, metric):
-        if metric+"_by_country" in self.dataframes:
-            return pd.concat([self.dataframes[metric + "_by_country"], self.dataframes[metric + "_by_continent"]])
-        elif metric.startswith("new") and metric.split(" ")[1] in self.dataframes:
+        # Memoized per data version. The frames are shared between callers, don't modify them.
+        key = (metric, self.version)
+        df = self.country_data_cache.get(key)
+        if df is None:
+            df = self.compute_country_data(metric)
+            if df is not None:
+                self.country_data_cache.put(key, df)
+        return df
+
+    def compute_country_data(self, metric):
+        # countries and continents, a view on the store
+        if metric in self.store.matrices:
+            return self.store.frame(metric)
+        elif metric.startswith("new") and metric.split(" ")[1] in self.store.matrices:
             metric = metric.split(" ")[1]
-            return pd.concat([self.dataframes[metric + "_by_country"].diff(axis="columns"),
-                              self.dataframes[metric + "_by_continent"].diff(axis="columns")]
-                             )
+            return self.store.frame(metric).diff(axis="columns")
         else:
             return None
 
+    def derived_metrics(self, avg_n=7, median_n=3):
+        # computed for all regions at once, and once per data version
+        # (version and store are read before computing, so a result is never cached under a
+        # newer version than the data it was computed from)
+        current, store = self.version, self.store
+        version, derived = self.derived.get((avg_n, median_n), (None, None))
+        if version != current:
+            derived = DerivedMetrics(store, "deaths", avg_n, median_n)
+            self.derived[(avg_n, median_n)] = (current, derived)
+        return derived
+
     def get_new_cases_details(self, country, avg_n=7, median_n=3):
-        deaths = self.get_country_data("deaths").loc[country]
-        df = pd.DataFrame(deaths)
-        df = df.rename(columns={country: "confirmed_deaths"})
-        df.loc[:, "new_deaths"] = np.maximum(0, deaths.diff())
-        df = df.loc[df.new_deaths > 1, :]
-        df.loc[:, "growth_factor"] = df.new_deaths.diff() / df.new_deaths.shift(1) + 1
-        df[~np.isfinite(df)] = np.nan
-        df.loc[:, "filtered_new_deaths"] = \
-            scipy.ndimage.convolve(df.new_deaths, np.ones(avg_n) / avg_n, origin=-avg_n // 2 + 1)
-        df.loc[:, "filtered_growth_factor"] = \
-            df.filtered_new_deaths.diff() / df.filtered_new_deaths.shift(1) + 1
-        df.filtered_growth_factor = scipy.ndimage.median_filter(df.filtered_growth_factor, median_n, mode="nearest")
-        return df
+        return self.derived_metrics(avg_n, median_n).details(country)
     
     def list_countries(self):
         options = []
@@ -244,3 +543,60 @@ class Covid19Processing:
         fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='LightGrey', tickformat= ',.0%')
         fig.update_traces(mode='lines')
         return fig
+
+
+class Covid19Dataset:
+    # One processed Covid19Processing instance shared by all callbacks of a worker.
+    # A background thread refreshes it every refresh_interval seconds: new days are appended
+    # to a copy, which then replaces the instance in one assignment, so callbacks never see a
+    # half updated instance. Every full_refresh_interval seconds the data is processed from
+    # scratch, to pick up revisions of past days.
+    def __init__(self, refresh_interval=data_refresh_interval, full_refresh_interval=data_full_refresh_interval,
+                 **kwargs):
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.processed_at = None
+        self.kwargs = kwargs  # passed on to Covid19Processing
+        self.kwargs.setdefault("session", create_session(pool_size=len(data_urls)))
+        self.version = 0
+        self.data = None
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            if self.data is None or time.time() - self.processed_at >= self.full_refresh_interval:
+                data = Covid19Processing(**self.kwargs)
+                data.process(rows=20, debug=False)
+                data.list_countries()
+                self.processed_at = time.time()
+                self.data = data
+                self.version += 1
+            else:
+                # only the new days are added, to a copy
+                data = self.data.copy()
+                if data.update() > 0:
+                    self.data = data
+                    self.version += 1
+
+    def get(self):
+        return self.data
+
+    def start(self):
+        # start the background refresh, once per process
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="covid19-refresh", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep serving the current version, try again next interval
+                print(f"Refreshing JHU data failed: {e}")
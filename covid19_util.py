@@ -1,3 +1,9 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 # Where to get the data. There have been some issues with the data quality lately. 
 # For the most recent data, use branch 'master'.
 # For stable March 13 data, use 'c2f5b63f76367505364388f5a189d1012e49e63e'
@@ -10,6 +16,42 @@ data_urls = {
     # No longer being updated: "recovered": "time_series_19-covid-Recovered.csv"
 }
 
+# Local copies of the downloaded data, see covid19_download.py
+cache_dir = "cache"
+request_timeout = 30  # seconds
+request_retries = 3
+
+# Bump when Covid19Processing.process() changes, so old processed snapshots are not reused
+snapshot_format = 4
+
+# Bump when the model or forecast_covid19.fit_REIS changes, so cached fits are not reused
+fit_cache_format = 2
+
+# Number of fit results kept on disk by forecast_covid19.fit_REIS (least recently used go first)
+fit_cache_size = 32
+
+# Number of get_country_data results kept per dataset
+country_data_cache_size = 8
+
+# Number of SEIR solutions kept by forecast_covid19.SEIR_solution
+seir_cache_size = 256
+
+# Day 0 of the SEIR model
+model_start = '16/2/2020'
+
+# IC beds available, the capacity R target is determined for
+ic_capacity = 1900
+
+# Worker processes for forecast_covid19.fit_many, None is one per fit (at most one per cpu)
+fit_workers = None
+
+# How often the dashboard reloads the JHU data in the background (seconds)
+data_refresh_interval = 6 * 60 * 60
+
+# How often the background refresh processes the JHU data from scratch instead of only
+# appending new days, to pick up revisions of past days (seconds)
+data_full_refresh_interval = 24 * 60 * 60
+
 continent_codes = {
     "AF": "Africa",
     "AN": "Antarctica",
@@ -20,6 +62,24 @@ continent_codes = {
     "SA": "South America"
 }
 
+# Change some weird formal names to more commonly used ones
+country_renames = {"Republic of Korea": "South Korea",
+                   "Holy See": "Vatican City",
+                   "Iran (Islamic Republic of)": "Iran",
+                   "Viet Nam": "Vietnam",
+                   "Taipei and environs": "Taiwan",
+                   "Republic of Moldova": "Moldova",
+                   "Russian Federaration": "Russia",
+                   "Korea, South": "South Korea",
+                   "Taiwan*": "Taiwan",
+                   "occupied Palestinian territory": "Palestine",
+                   "Bahamas, The": "Bahamas",
+                   "Cote d'Ivoire": "Ivory Coast",
+                   "Gambia, The": "Gambia",
+                   "US": "United States",
+                   "Cabo Verde": "Cape Verde",
+                   }
+
 
 mapping = {"Patients in hospital": "Hosp_tot",
            "Patients on IC": "IC_total",
@@ -51,4 +111,67 @@ title_font = {
         "family": "Courier New, monospace",
         "size": 20,
         "color": "#24292e"
-        }
\ No newline at end of file
+        }
+
+
+@contextmanager
+def atomic_write(path):
+    # Yields a temporary path next to path to write a file (or a directory) to. When the block
+    # completes it replaces path in one rename, so other threads and workers see the old or the
+    # new version, never half of it. The temporary name ends in ".tmp".
+    # A directory that another writer put in place first is kept, ours is discarded.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class LRUCache:
+    # Bounded least-recently-used cache, safe to share between threads.
+    # Keeps hit, miss and eviction counters, see stats().
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.data),
+                "maxsize": self.maxsize}
@@ -10,19 +10,233 @@ Created on Thu Mar 26 15:06:50 2020
 import numpy as np
 import pandas as pd
 from scipy.integrate import odeint
-import bisect
 import scipy
+import scipy.integrate
+import scipy.stats
 import plotly.graph_objs as go
 import covid19_util as util
 from io import StringIO
+import base64
+import os
+import json
+import threading
+import multiprocessing
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import parameters
 
+# Compartments of the SEIR model, in the order of the state vector
+compartments = ['Susceptible', 'Exposed', 'I_total', 'I_mild', 'I_pre_hosp',
+                'I_hosp', 'I_pre_ic', 'I_ic', 'I_fatal', 'R_mild', 'R_hosp',
+                'R_ic', 'R_fatal']
+
+
+class SEIR_parameters:
+    # Parameters and derived rates of the SEIR model.
+    # All parameters are imported from parameters.py, t_inc, t_inf and t_ic can be
+    # overridden (999 means default).
+    def __init__(self, t_inc = 999, t_inf = 999, t_ic = 999):
+        # parameters which can be set via an argument are checked and otherwise adjusted to default
+        self.t_inc = parameters.Const.t_inc if t_inc == 999 else t_inc
+        self.t_inf = parameters.Const.t_inf if t_inf == 999 else t_inf
+        self.t_ic = parameters.Const.t_ic if t_ic == 999 else t_ic
+
+        # Time periods (days)
+        self.t_mild = parameters.Const.t_mild # duration of mild case
+        self.t_hosp = parameters.Const.t_hosp # duration for hospital, but non IC cases
+        self.t_fatal = parameters.Const.t_fatal
+        self.t_hlag = parameters.Const.t_hlag # duration before patient ends up in hospital
+
+        # Clinical proportions
+        self.p_mild = parameters.Const.p_mild
+        p_hosp_0 = parameters.Const.p_hosp_0 # hospitalised
+        p_ic_0 = parameters.Const.p_ic_0 # IC % from dutch figures
+
+        # mortality
+        self.p_fatal = parameters.Const.p_fatal
+        p_fatal_ic = parameters.Const.p_fatal_ic # 50% of fatalities come from IC
+
+        # basic parameters
+        self.N = 17000000  # initial susceptible population
+        self.i0 = 1 # number of infected people at t0
+        self.R0 = 2.2  # not used is fitted instead
+        self.s0 = self.N - self.i0 / self.N
+
+        # Static calculations
+        self.alfa = 1 / self.t_inc
+        self.gamma = 1 / self.t_inf
+
+        self.t_mild_net = self.t_mild - self.t_inf
+        self.t_hosp_net = self.t_hosp - self.t_inf
+        self.t_ic_net = self.t_ic - self.t_inc
+
+        self.p_hosp = p_hosp_0 - (1-p_fatal_ic) * self.p_fatal
+        self.p_ic = p_ic_0 - p_fatal_ic * self.p_fatal
+        assert(self.p_mild+self.p_hosp+self.p_ic+self.p_fatal == 1)
+
+        # The model in matrix form: dU/dt = A U + b * beta * s * i / N
+        # A holds all linear transitions between compartments, b moves new infections from s to e
+        s, e, i, i_mild, i_pre_hosp, i_hosp, i_pre_ic, i_ic, i_fatal, r_mild, r_hosp, r_ic, r_fatal = range(13)
+        A = np.zeros((13, 13))
+        A[e, e] = -self.alfa
+        A[i, e] = self.alfa
+        A[i, i] = -self.gamma
+
+        # splitting up infectious
+        A[i_mild, i] = self.p_mild * self.gamma
+        A[i_mild, i_mild] = -1 / self.t_mild_net
+        A[i_pre_hosp, i] = self.p_hosp * self.gamma
+        A[i_pre_hosp, i_pre_hosp] = -1 / self.t_hlag
+        A[i_hosp, i_pre_hosp] = 1 / self.t_hlag
+        A[i_hosp, i_hosp] = -1 / self.t_hosp_net
+        A[i_pre_ic, i] = self.p_ic * self.gamma
+        A[i_pre_ic, i_pre_ic] = -1 / self.t_hlag
+        A[i_ic, i_pre_ic] = 1 / self.t_hlag
+        A[i_ic, i_ic] = -1 / self.t_ic_net
+        A[i_fatal, i] = self.p_fatal * self.gamma
+        A[i_fatal, i_fatal] = -1 / self.t_fatal
+
+        A[r_mild, i_mild] = 1 / self.t_mild_net
+        A[r_hosp, i_hosp] = 1 / self.t_hosp_net
+        A[r_ic, i_ic] = 1 / self.t_ic_net
+        A[r_fatal, i_fatal] = 1 / self.t_fatal
+        self.A = A
+
+        self.b = np.zeros(13)
+        self.b[s] = -1
+        self.b[e] = 1
+
+    def key(self):
+        # canonical, hashable form of all parameters, including those in parameters.Const
+        const = tuple(sorted((k, v) for k, v in vars(parameters.Const).items() if not k.startswith("_")))
+        return (round(self.t_inc, 10), round(self.t_inf, 10), round(self.t_ic, 10)) + const
+
+    def initial_state(self, e0 = 20):
+        return [self.s0, e0, self.i0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+
+    def derivatives(self, U, beta):
+        # U is a single state or a (13 x K) stack of states, beta a scalar or K values.
+        # Linear transitions plus the single bilinear infection term beta * s * i / N
+        infections = beta * U[0] * U[2] / self.N
+        return self.A @ U + np.multiply.outer(self.b, infections)
+
+    def jacobian(self, U, beta):
+        # d(derivatives)/dU for a single state: the constant linear part plus the derivatives
+        # of the infection term with respect to s and i
+        J = self.A.copy()
+        J[:, 0] += self.b * beta * U[2] / self.N
+        J[:, 2] += self.b * beta * U[0] / self.N
+        return J
+
+    def sensitivity_derivatives(self, X, beta, dbeta):
+        # Forward sensitivity system: X is the state U followed by dU/dy for every parameter y,
+        # flattened. dbeta holds dbeta/dy per parameter, so
+        # d/dt dU/dy = jacobian(U) dU/dy + b * dbeta/dy * s * i / N
+        # All rows share the linear part A, only the coefficient of b differs per row.
+        X = X.reshape(-1, 13)
+        U, S = X[0], X[1:]
+        infections = U[0] * U[2] / self.N
+        coefficients = np.concatenate([[beta * infections],
+                                       beta * (S[:, 0] * U[2] + U[0] * S[:, 2]) / self.N + dbeta * infections])
+        return (X @ self.A.T + np.multiply.outer(coefficients, self.b)).ravel()
+
+    def sensitivity_jacobian(self, X, beta, dbeta):
+        # jacobian of sensitivity_derivatives: block lower triangular with jacobian(U) on the
+        # diagonal, the infection term is bilinear so the off diagonal blocks are simple
+        X = X.reshape(-1, 13)
+        U, S = X[0], X[1:]
+        n = len(X)
+        J = self.jacobian(U, beta)
+        JX = np.kron(np.eye(n), J)
+        for k in range(1, n):
+            rows = slice(13 * k, 13 * (k + 1))
+            JX[rows, 0] += self.b * (beta * S[k - 1][2] + dbeta[k - 1] * U[2]) / self.N
+            JX[rows, 2] += self.b * (beta * S[k - 1][0] + dbeta[k - 1] * U[0]) / self.N
+        return JX
+
+
+# Aggregates of the compartments, as weights on the state vector (see SEIR_result)
+aggregates = {
+    # patients on IC, half of the fatal cases die on IC
+    "IC_total": {"I_ic": 1, "I_fatal": 0.5},
+    # patients in hospital
+    "Hosp_tot": {"I_hosp": 1, "I_ic": 1, "I_fatal": 1},
+    "R_total": {"R_mild": 1, "R_hosp": 1, "R_ic": 1},
+    # cumulative hospital admissions, the series fitted to hospitalizations.csv
+    "admissions": {"I_hosp": 1, "I_ic": 1, "R_hosp": 1, "R_ic": 1, "I_fatal": 0.5, "R_fatal": 0.5},
+}
+aggregate_weights = np.array([[weights.get(c, 0) for c in compartments] for weights in aggregates.values()]).T
+
+
+class SEIR_result:
+    # Solution of the SEIR model: a (days x 13) array, compartments in the order of
+    # `compartments`. Compartments are available as attributes (result.I_ic) or by name
+    # (result["I_ic"]), as are "day" and the aggregates above. ic_load, hospital_load, recovered
+    # and admissions are the aggregates under a readable name.
+    # All views are read only, the array may be shared with the solution cache.
+    def __init__(self, values):
+        self.values = values
+        self.totals = values @ aggregate_weights # (days x aggregates), one product for all of them
+        self.totals.setflags(write = False)
+        self.day = np.arange(len(values), dtype=float)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails; self.__dict__ because values may not be set yet
+        values = self.__dict__.get("values")
+        if values is not None and name in compartments:
+            return values[:, compartments.index(name)]
+        raise AttributeError(name)
+
+    def __getitem__(self, name):
+        if name in aggregates:
+            return self.totals[:, list(aggregates).index(name)]
+        if name == "day":
+            return self.day
+        if name in compartments:
+            return getattr(self, name)
+        raise KeyError(name)
+
+    @property
+    def ic_load(self):
+        return self["IC_total"]
+
+    @property
+    def hospital_load(self):
+        return self["Hosp_tot"]
+
+    @property
+    def recovered(self):
+        return self["R_total"]
+
+    @property
+    def admissions(self):
+        return self["admissions"]
+
+    def to_frame(self, totals = False):
+        # DataFrame with a column per compartment and the day, optionally with the aggregates
+        df = pd.DataFrame(self.values, columns = compartments)
+        if totals:
+            for name in aggregates:
+                df[name] = self[name]
+        df['day'] = self.day
+        return df
+
+
 class forecast_covid19:
-    def __init__(self):
-        self.hospitals = pd.read_csv("hospitalizations.csv", sep = ";")
+    def __init__(self, hospitals = None, cache_dir = util.cache_dir):
+        self.hospitals = pd.read_csv("hospitalizations.csv", sep = ";") if hospitals is None else hospitals
+        self.cache_dir = cache_dir # warm starts of the fits, see fit_REIS
         self.forecasts = {}
         self.factors = {}
         self.results = {}
+        self.targets = {}  # name -> (R values, IC demand per R), see precompute_targets
+        self.intervals = {} # name -> confidence interval per factor, see profile_likelihood
+        self.bands = {} # name -> {aggregate: (lower, upper)}, see profile_likelihood
+        self.factor_bounds = (0.000001, 3.95/2.2) # lower and upper bound for the factors on R
+        self.solution_cache = util.LRUCache(maxsize = util.seir_cache_size) # see SEIR_solution
         self.MAX_RANGE = 100000
 
     def get_NICE_data(self):
@@ -38,125 +252,330 @@ class forecast_covid19:
                # self.ic_actuals = "empty"
         
     def SEIR_solution(self, intervention = [(100,1), (100000, 0.2)],e0 = 20,
-                      days = 150, t_inc = 999, t_inf = 999, t_ic = 999):
-
-        # All parameters are imported from parameters.py
-        #
-
-        # parameters which can be set via an argument are checked and otherwise adjusted to default
-        t_inc = parameters.Const.t_inc if t_inc == 999 else t_inc
-        t_inf = parameters.Const.t_inf if t_inf == 999 else t_inf
-        t_ic = parameters.Const.t_ic if t_ic == 999 else t_ic
+                      days = 150, t_inc = 999, t_inf = 999, t_ic = 999, use_cache = True,
+                      solver = "lsoda"):
 
+        # All parameters are imported from parameters.py, see SEIR_parameters
+        p = SEIR_parameters(t_inc, t_inf, t_ic)
 
         # Array of tuples: (day, Rint), Rint = 1 means no measures (eg 100% R0)
         # (up_to_day, Rint), (up_to_day, Rint)
-        intervention.sort() # list must be sorted
-
-
-        # Time periods (days)
-        t_mild = parameters.Const.t_mild # duration of mild case
-        t_hosp = parameters.Const.t_hosp # duration for hospital, but non IC cases
-        t_fatal = parameters.Const.t_fatal
-        t_hlag = parameters.Const.t_hlag # duration before patient ends up in hospital
-
-        # Clinical proportions
-        p_mild = parameters.Const.p_mild
-        p_hosp_0 = parameters.Const.p_hosp_0 # hospitalised
-        p_ic_0 = parameters.Const.p_ic_0 # IC % from dutch figures
-
-        # mortality
-        p_fatal = parameters.Const.p_fatal
-        p_fatal_ic = parameters.Const.p_fatal_ic # 50% of fatalities come from IC
-        
-        # basic parameters
-        N = 17000000  # initial susceptible population
-        i0 = 1 # number of infected people at t0
-        R0 = 2.2  # not used is fitted instead
-        s0 = N - i0 / N
-
-        # Static calculations
-        alfa = 1 / t_inc
-        gamma = 1 / t_inf
-
-        t_mild_net = t_mild - t_inf
-        t_hosp_net = t_hosp - t_inf
-        t_ic_net = t_ic - t_inc
-
-        p_hosp = p_hosp_0 - (1-p_fatal_ic) * p_fatal
-        p_ic = p_ic_0 - p_fatal_ic * p_fatal
-        assert(p_mild+p_hosp+p_ic+p_fatal == 1)
-
-
-        def dUdt(U, t):
-            s, e, i, i_mild, i_pre_hosp, i_hosp, i_pre_ic, i_ic, i_fatal, r_mild, r_hosp, r_ic, r_fatal = U
-
-            # calculate beta taking measures into account. Depends on t
-            pos = bisect.bisect_right(intervention, (t,))
-            Rint = intervention[pos][1]
-            beta = Rint * R0 / t_inf
-
-            dsdt = -beta * i / N * s
-            dedt = beta * i/ N * s - alfa * e
-            didt = alfa * e - gamma * i
-
-            # splitting up infectious
-            di_mild = p_mild * gamma * i - (1/t_mild_net) * i_mild
-            di_pre_hosp = p_hosp * gamma * i - (1 / t_hlag ) * i_pre_hosp
-            di_hosp = (1 / t_hlag) * i_pre_hosp - (1/t_hosp_net) * i_hosp
-            di_pre_ic = p_ic * gamma * i - (1 / t_hlag ) * i_pre_ic
-            di_ic = (1 / t_hlag ) * i_pre_ic - (1/t_ic_net) * i_ic
-            di_fatal = p_fatal * gamma * i - (1/t_fatal) * i_fatal
-
-            dr_mild = (1/t_mild_net) * i_mild
-            dr_hosp = (1/t_hosp_net) * i_hosp
-            dr_ic = (1/t_ic_net) * i_ic
-            dr_fatal = (1/t_fatal) * i_fatal
-
-            return [dsdt, dedt, didt, di_mild, di_pre_hosp,
-                    di_hosp, di_pre_ic, di_ic, di_fatal,
-                    dr_mild, dr_hosp, dr_ic, dr_fatal]
-
-        # Create time domain
-        t_span = np.linspace(0, days, days, endpoint=False)
-
-        # Initial condition
-        Uzero = [s0, e0, i0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-        solution = odeint(dUdt, Uzero, t_span)
-
-        # some post manipulation and calculation of mortality rates
-        df = pd.DataFrame(solution)
-
-        # add column names
-        df.columns = ['Susceptible', 'Exposed', 'I_total', 'I_mild', 'I_pre_hosp',
-                      'I_hosp', 'I_pre_ic', 'I_ic', 'I_fatal', 'R_mild', 'R_hosp',
-                      'R_ic', 'R_fatal']
-
-        # add timeframe as a column
-        df['day'] = t_span
-        return df
-
-    def fit_REIS(self, cutoff = 30, name = 'default', days_back = 0):
+        intervention = sorted(intervention) # list must be sorted, leave the caller's list alone
+
+        # Solutions are cached on the full set of inputs except the horizon: a cached solution is
+        # sliced for shorter horizons and integrated further for longer ones, so the same
+        # day has the same value whatever the horizon.
+        key = p.key() + (tuple((round(day, 10), round(Rint, 10)) for day, Rint in intervention),
+                         round(e0, 10), solver)
+        solution = self.solution_cache.get(key) if use_cache else None
+
+        # calculate beta taking measures into account, per segment of the schedule
+        segments = [(day, Rint * p.R0 / p.t_inf) for day, Rint in intervention]
+
+        if solution is None or len(solution) == 0:
+            # Initial condition, one point per day
+            solution = self.integrate(p.derivatives, segments, p.initial_state(e0), np.arange(days, dtype=float),
+                                      jacobian = p.jacobian, solver = solver)
+            if use_cache:
+                self.solution_cache.put(key, solution)
+        elif len(solution) < days:
+            # continue from the last day of the cached solution
+            t_span = np.arange(len(solution) - 1, days, dtype=float)
+            extension = self.integrate(p.derivatives, segments, solution[-1], t_span,
+                                       jacobian = p.jacobian, solver = solver)
+            solution = np.concatenate([solution, extension[1:]])
+            self.solution_cache.put(key, solution)
+
+        # cached arrays are shared between results, keep them read only
+        solution.setflags(write = False)
+        return SEIR_result(solution[:days])
+
+    def SEIR_sensitivity(self, intervention = [(100,1), (100000, 0.2)], e0 = 20, days = 150):
+        # Solution together with its derivatives with respect to the Rint of every segment of the
+        # intervention schedule, integrated as one system (see SEIR_parameters.sensitivity_derivatives).
+        # Returns the SEIR_result and a (segments x days x 13) array of sensitivities.
+        p = SEIR_parameters()
+        intervention = sorted(intervention)
+        k = len(intervention)
+        scale = p.R0 / p.t_inf
+        # beta = Rint * R0 / t_inf depends on the Rint of its own segment only
+        segments = [(day, (Rint * scale, scale * np.eye(k)[j])) for j, (day, Rint) in enumerate(intervention)]
+        Xzero = np.concatenate([p.initial_state(e0), np.zeros(13 * k)])
+        X = self.integrate(lambda X, beta: p.sensitivity_derivatives(X, *beta), segments, Xzero,
+                           np.arange(days, dtype=float),
+                           jacobian = lambda X, beta: p.sensitivity_jacobian(X, *beta))
+        X = X.reshape(days, k + 1, 13)
+        return SEIR_result(X[:, 0]), X[:, 1:].transpose(1, 0, 2)
+
+    def integrate(self, derivatives, segments, Uzero, t_span, jacobian = None, solver = "lsoda", **kwargs):
+        # Integrate dU/dt = derivatives(U, beta) from state Uzero at t_span[0] and return the
+        # states at t_span. segments is a piecewise constant schedule [(up_to_day, beta), ...]:
+        # every constant segment is integrated on its own and the state carried to the next
+        # one, so the integrator never steps across a change of R.
+        # solver "lsoda" is odeint (switches between stiff and non-stiff methods itself, kwargs
+        # go to odeint), "stiff" is solve_ivp's BDF and "nonstiff" solve_ivp's RK45, both with
+        # odeint's default tolerances. jacobian(U, beta) is used by "lsoda" and "stiff".
+        Uzero = np.asarray(Uzero, dtype=float)
+        solution = np.empty((len(t_span), len(Uzero)))
+        if len(t_span) == 0:
+            return solution
+        solution[0] = Uzero
+        U = Uzero
+        t = t_span[0]
+        i = 1 # next output point
+        for day, beta in segments:
+            if i >= len(t_span):
+                break
+            if day <= t:
+                continue
+            end = min(day, t_span[-1])
+            j = np.searchsorted(t_span, end, side="right")
+            times = np.concatenate([[t], t_span[i:j]])
+            if times[-1] < end:
+                times = np.append(times, end)
+            if solver == "lsoda":
+                Dfun = None if jacobian is None else (lambda U, t: jacobian(U, beta))
+                segment = odeint(lambda U, t: derivatives(U, beta), U, times, Dfun = Dfun, **kwargs)
+            elif solver in ("stiff", "nonstiff"):
+                options = {"method": "BDF", "jac": (None if jacobian is None else (lambda t, U: jacobian(U, beta)))} \
+                          if solver == "stiff" else {"method": "RK45"}
+                result = scipy.integrate.solve_ivp(lambda t, U: derivatives(U, beta), (times[0], times[-1]), U,
+                                                   t_eval = times, rtol = 1.49012e-8, atol = 1.49012e-8, **options)
+                if not result.success:
+                    raise RuntimeError(f"SEIR integration failed: {result.message}")
+                segment = result.y.T
+            else:
+                raise ValueError(f"Unknown solver {solver}")
+            solution[i:j] = segment[1:1 + j - i]
+            U = segment[-1]
+            t = end
+            i = j
+        if i < len(t_span):
+            raise ValueError("Intervention schedule ends before the last day")
+        return solution
+
+    def SEIR_ensemble(self, params, cutoff = 30, e0 = 20, days = 150, method = "odeint", steps_per_day = 4):
+        # Solve K parameter sets at once. params is a (K x 2) or (K x 4) array with rows
+        # (factor before cutoff, factor after cutoff[, t_inc, t_ic]), 999 meaning default as in
+        # SEIR_solution. All trajectories are integrated together on a (K x 13) state: stacked
+        # into one adaptive odeint call ("odeint") or with vectorized fixed-step RK4 ("rk4",
+        # steps_per_day steps per day; cheaper for large K, cutoff is rounded to a step).
+        # Returns a (K x days x 13) array, compartments in the order of `compartments`.
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        K = len(params)
+        factors = params[:, :2]
+        if params.shape[1] > 2:
+            models = [SEIR_parameters(t_inc, 999, t_ic) for t_inc, t_ic in params[:, 2:4]]
+        else:
+            models = [SEIR_parameters()]
+        A = np.stack([m.A for m in models]) # (K or 1) x 13 x 13
+        p = models[0] # N, R0, t_inf and the initial state are shared
+        scale = p.R0 / p.t_inf
+
+        def derivatives(U, beta):
+            infections = beta * U[:, 0] * U[:, 2] / p.N
+            return np.matmul(A, U[:, :, None])[:, :, 0] + infections[:, None] * p.b
+
+        Uzero = np.tile(np.array(p.initial_state(e0), dtype=float), (K, 1))
+        if method == "odeint":
+            # the systems are independent: a banded jacobian keeps LSODA's work arrays O(K)
+            segments = [(cutoff, scale * factors[:, 0]), (self.MAX_RANGE, scale * factors[:, 1])]
+            solution = self.integrate(lambda U, beta: derivatives(U.reshape(K, 13), beta).ravel(),
+                                      segments, Uzero.ravel(), np.arange(days, dtype=float), ml = 12, mu = 12)
+            return solution.reshape(days, K, 13).transpose(1, 0, 2)
+        elif method == "rk4":
+            h = 1 / steps_per_day
+            solution = np.empty((K, days, 13))
+            U = Uzero
+            for day in range(days):
+                if day > 0:
+                    for step in range(steps_per_day):
+                        t = day - 1 + step * h
+                        beta = scale * (factors[:, 0] if t < cutoff else factors[:, 1])
+                        k1 = derivatives(U, beta)
+                        k2 = derivatives(U + h / 2 * k1, beta)
+                        k3 = derivatives(U + h / 2 * k2, beta)
+                        k4 = derivatives(U + h * k3, beta)
+                        U = U + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+                solution[:, day] = U
+            return solution
+        raise ValueError(f"Unknown method {method}")
+
+    def precompute_targets(self, name = 'outlook', R_values = None, cutoff = 30):
+        # IC demand for every position of the R target slider, solved in one batch after a fit.
+        # Slider callbacks then only index the (R x days) float32 matrix, see target_ic.
+        if R_values is None:
+            R_values = np.round(np.arange(0, 2 + 1e-9, 0.01), 2)
+        R_values = np.asarray(R_values, dtype=float)
+        params = np.column_stack([np.full(len(R_values), self.factors[name][0]), R_values / 2.2])
+        solution = self.SEIR_ensemble(params, cutoff = cutoff)
+        ic = solution[:, :, compartments.index("I_ic")] + 0.5 * solution[:, :, compartments.index("I_fatal")]
+        self.targets[name] = (R_values, ic.astype(np.float32))
+
+    def slider_payload(self, name = 'outlook'):
+        # precomputed IC demand as a compact payload for the browser: the (R x days) matrix as
+        # base64 encoded little endian float32, decoded into a Float32Array by assets/sliders.js
+        R_values, ic = self.targets[name]
+        return {"R": R_values.tolist(),
+                "step": float(R_values[1] - R_values[0]),
+                "days": ic.shape[1],
+                "ic": base64.b64encode(ic.astype('<f4').tobytes()).decode('ascii')}
+
+    def target_ic(self, R, name = 'outlook', cutoff = 30):
+        # IC demand for target R, from the precomputed matrix when R is on its grid
+        if name in self.targets:
+            R_values, ic = self.targets[name]
+            pos = np.searchsorted(R_values, R - 1e-9)
+            if pos < len(R_values) and abs(R_values[pos] - R) < 1e-9:
+                return ic[pos]
+        solution = self.SEIR_solution(intervention = [(cutoff,self.factors[name][0]),
+                                                      (self.MAX_RANGE,R/2.2)])
+        return solution.ic_load
+
+    def warm_start_path(self, name, cutoff, days_back):
+        return os.path.join(self.cache_dir, "warm_start", f"{name}_{cutoff}_{days_back}.json")
+
+    def load_warm_start(self, name, cutoff, days_back):
+        # factors and optimizer state of the last fit with these settings, None if there is none
+        path = self.warm_start_path(name, cutoff, days_back)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_warm_start(self, name, cutoff, days_back, result):
+        # one file per fit, so parallel fits (fit_many) never overwrite each other's state
+        path = self.warm_start_path(name, cutoff, days_back)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        state = {"factors": [float(x) for x in result.x],
+                 "loss": float(result.fun),
+                 "nit": int(result.nit),
+                 "hospital_days": len(self.hospitals) - days_back}
+        with util.atomic_write(path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+
+    def fit_key(self, hospital_hist, cutoff, days_back, sensitivity):
+        # A fit depends only on the hospital data it sees, its settings and the model parameters:
+        # hash those, so identical inputs map to the same cached result in every worker
+        fingerprint = hashlib.sha1(f"fit format {util.fit_cache_format}".encode("utf-8"))
+        fingerprint.update(hospital_hist.to_csv(index = False).encode("utf-8"))
+        fingerprint.update(repr((cutoff, days_back, sensitivity, SEIR_parameters().key())).encode("utf-8"))
+        return fingerprint.hexdigest()
+
+    def fit_path(self, key):
+        return os.path.join(self.cache_dir, "fits", key + ".npz")
+
+    def load_fit(self, key):
+        # (factors, forecast, optimizer result) of a cached fit, None if there is none
+        path = self.fit_path(key)
+        try:
+            with np.load(path) as f:
+                factors = f["factors"]
+                forecast = SEIR_result(f["forecast"])
+                diagnostics = json.loads(str(f["diagnostics"]))
+            os.utime(path) # last use, see save_fit
+        except (OSError, ValueError, KeyError):
+            return None
+        diagnostics["jac"] = np.array(diagnostics["jac"])
+        return factors, forecast, scipy.optimize.OptimizeResult(x = factors, **diagnostics)
+
+    def save_fit(self, key, factors, forecast, result):
+        path = self.fit_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        diagnostics = {"fun": float(result.fun), "jac": np.asarray(result.jac, dtype=float).tolist(),
+                       "nit": int(result.nit), "nfev": int(result.nfev),
+                       "success": bool(result.success), "status": int(result.status),
+                       "message": result.message if isinstance(result.message, str) else result.message.decode()}
+        with util.atomic_write(path) as tmp_path:
+            with open(tmp_path, "wb") as f: # a file object, np.savez would append .npz to a name
+                np.savez(f, factors = factors, forecast = forecast.values,
+                         diagnostics = np.array(json.dumps(diagnostics)))
+
+        # keep the most recently used fits only (load_fit touches the file). Other processes
+        # save and evict at the same time, so files can disappear while this runs.
+        directory = os.path.dirname(path)
+        fits = []
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                fits.append((os.stat(os.path.join(directory, name)).st_mtime, name))
+            except FileNotFoundError:
+                pass
+        for _, name in sorted(fits, reverse = True)[util.fit_cache_size:]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def fit_values(self, days_back = 0):
+        # cumulative hospital admissions a fit with days_back compares the model with
+        return self.hospitals.iloc[0:len(self.hospitals)-days_back,1].values.astype(float)
+
+    def fit_loss(self, factors, hospital_values, cutoff = 30, gradient = False):
+        # The loss fit_REIS minimizes: root mean squared error of the modelled cumulative
+        # admissions over every day of hospital_values. With gradient = True returns the loss
+        # and its gradient, d rmse/dy = mean(residual * d model/dy) / rmse, from the
+        # sensitivity equations (SEIR_sensitivity).
+        y1,y2 = factors
+        intervention = [(cutoff,y1), (self.MAX_RANGE,y2)]
+        days = len(hospital_values)
+        if not gradient:
+            outcome = self.SEIR_solution(intervention = intervention, days = days,
+                                         use_cache = False) # don't flood the cache with optimizer steps
+            return np.sqrt(np.mean((outcome.admissions - hospital_values)**2))
+        outcome, sensitivities = self.SEIR_sensitivity(intervention = intervention, days = days)
+        residual = outcome.admissions - hospital_values
+        loss = np.sqrt(np.mean(residual**2))
+        d_model = sensitivities @ aggregate_weights[:, list(aggregates).index("admissions")]
+        return loss, (d_model @ residual) / (days * loss) if loss > 0 else np.zeros(2)
+
+    def fit_REIS(self, cutoff = 30, name = 'default', days_back = 0, sensitivity = False, warm_start = True,
+                 use_cache = True):
+        # sensitivity = True gives the optimizer the exact gradient of the loss, from the
+        # sensitivity equations (SEIR_sensitivity), instead of finite differences
+        # warm_start = True starts from the factors of the previous fit with the same name, cutoff
+        # and days_back (kept in cache_dir across restarts) instead of the default guess, unless
+        # the data changed so much that the default guess fits better
+        # use_cache = True reuses the result of an earlier fit on identical inputs (see fit_key),
+        # from this or any other worker sharing cache_dir
 
         # filter hostpitals
         hospital_hist = self.hospitals.iloc[0:len(self.hospitals)-days_back,:]
 
         #parameters
-        factor_lbound = 0.000001 #lower bound for factor on R
-        factor_ubound = 3.95/2.2 #upper bound for factor on R
-
-        # use root mean squared error as loss function
+        factor_lbound, factor_ubound = self.factor_bounds
+        hospital_values = self.fit_values(days_back)
+
+        key = self.fit_key(hospital_hist, cutoff, days_back, sensitivity)
+        cached = self.load_fit(key) if use_cache else None
+        if cached is not None:
+            self.factors[name], self.forecasts[name], self.results[name] = cached
+            self.targets.pop(name, None)
+            self.intervals.pop(name, None)
+            self.bands.pop(name, None)
+            return
+
+        # use root mean squared error over all days as loss function, see fit_loss
         def rmse(factors):
-            y1,y2 = factors
-            outcome = self.SEIR_solution(intervention =
-                                         [(cutoff,y1),
-                                          (self.MAX_RANGE,y2)])
-            model_hosp = (outcome["I_hosp"] +outcome["I_ic"]+outcome["R_hosp"]+outcome["R_ic"]+\
-                          0.5*outcome["I_fatal"]+0.5*outcome["R_fatal"]).iloc[:len(self.hospitals)]
-            return np.sqrt(np.mean((model_hosp - hospital_hist.iloc[:,1])**2))
+            return self.fit_loss(factors, hospital_values, cutoff)
+
+        def rmse_gradient(factors):
+            return self.fit_loss(factors, hospital_values, cutoff, gradient = True)
+
+        # initial guess
+        x0 = [1.7,0.8]
+        state = self.load_warm_start(name, cutoff, days_back) if warm_start else None
+        if state is not None:
+            previous = np.clip(state["factors"], factor_lbound, factor_ubound)
+            if rmse(previous) <= rmse(x0):
+                x0 = previous
 
         # minimize loss function
-        opt1 = scipy.optimize.minimize(rmse, [1.7,0.8],
+        opt1 = scipy.optimize.minimize(rmse_gradient if sensitivity else rmse, x0,
+                                       jac = sensitivity,
                                        bounds = [(factor_lbound, factor_ubound),
                                                  (factor_lbound, factor_ubound)],
                                        method = "L-BFGS-B")
@@ -168,19 +587,154 @@ class forecast_covid19:
                                                    (self.MAX_RANGE,factors[1])])
         self.factors[name] = factors
         self.results[name] = opt1
-
-    def determine_Rtarget(self, name = 'default'):
-        #determine Rtarget
-        Rtarget = 2
-        maximum = 50000
-
-        while maximum > 1900:
-            Rtarget = Rtarget - 0.01
-            solution =  self.SEIR_solution(intervention = [(30,self.factors[name][0]),
-                                                           (self.MAX_RANGE,Rtarget/2.2)])
-            IC = solution["I_ic"] + 0.5 * solution["I_fatal"]
-            maximum = IC.max()
-        return Rtarget
+        self.targets.pop(name, None) # based on the previous fit
+        self.intervals.pop(name, None)
+        self.bands.pop(name, None)
+        if warm_start:
+            self.save_warm_start(name, cutoff, days_back, opt1)
+        if use_cache:
+            self.save_fit(key, factors, self.forecasts[name], opt1)
+
+    def fit_many(self, jobs, max_workers = util.fit_workers):
+        # Run independent fits in parallel. jobs is a list of fit_REIS keyword arguments, eg
+        # [{"name": "outlook"}, {"name": "previous_forecast", "days_back": 7}]; every job runs in a
+        # worker process and its factors, forecast and optimizer result are stored under its name
+        # as if fit_REIS had been called here. With one worker the fits run in this process.
+        # Workers are forked: call this before starting any threads. Forking a process with
+        # other threads running can deadlock on a lock one of them holds, so then (and where
+        # fork is not available; spawn would run app.py again in every worker) the fits run
+        # in this process as well.
+        jobs = [dict(job) for job in jobs]
+        if max_workers is None:
+            max_workers = min(len(jobs), os.cpu_count() or 1)
+        can_fork = "fork" in multiprocessing.get_all_start_methods() and threading.active_count() == 1
+        if max_workers <= 1 or len(jobs) <= 1 or not can_fork:
+            for job in jobs:
+                self.fit_REIS(**job)
+            return
+        with ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context("fork")) as pool:
+            futures = [pool.submit(_fit_job, self.hospitals, self.cache_dir, job) for job in jobs]
+            for job, future in zip(jobs, futures):
+                name = job.get("name", "default")
+                self.factors[name], self.forecasts[name], self.results[name] = future.result()
+                self.targets.pop(name, None)
+                self.intervals.pop(name, None)
+                self.bands.pop(name, None)
+
+    def profile_likelihood(self, name = 'default', cutoff = 30, days_back = 0, level = 0.95,
+                           grid = 21, span = 0.5, rounds = 3):
+        # Confidence intervals for the factors of fit name (fitted with the same cutoff and
+        # days_back). With gaussian errors of unknown variance n * log(SSE / SSE_min) is
+        # approximately chi2 distributed; consecutive days are correlated, so treat the intervals
+        # as a lower bound on the uncertainty.
+        # The loss is evaluated on a grid x grid mesh of (factor1, factor2), +-span around the fit,
+        # in one SEIR_ensemble batch per round; every round narrows the mesh to the confidence region.
+        # Stores the interval per factor (profiled over the other factor) in self.intervals[name],
+        # and in self.bands[name] the lower and upper bound of every aggregate (IC_total, Hosp_tot, ...)
+        # of the forecasts within the joint confidence region.
+        # the loss of the fit (fit_loss) on every mesh point: SSE = n * rmse**2 over the same days
+        hospital_values = self.fit_values(days_back)
+        n = len(hospital_values)
+        weights = aggregate_weights[:, list(aggregates).index("admissions")]
+        threshold = scipy.stats.chi2.ppf(level, 2) # joint region, contains the profile intervals
+        lbound, ubound = self.factor_bounds
+
+        factors = np.asarray(self.factors[name], dtype=float)
+        low = np.clip(factors * (1 - span), lbound, ubound)
+        high = np.clip(factors * (1 + span), lbound, ubound)
+        for _ in range(rounds):
+            axes = [np.linspace(low[j], high[j], grid) for j in range(2)]
+            mesh = np.stack(np.meshgrid(*axes, indexing = "ij"), axis = -1).reshape(-1, 2)
+            solution = self.SEIR_ensemble(mesh, cutoff = cutoff, days = n)
+            sse = (((solution @ weights) - hospital_values)**2).sum(axis = 1).reshape(grid, grid)
+            statistic = n * np.log(sse / sse.min())
+            region = statistic <= threshold
+
+            # narrow to the region plus one grid step, widen where it runs off the mesh
+            for j in range(2):
+                inside = np.flatnonzero(region.any(axis = 1 - j))
+                first, last = inside[0], inside[-1]
+                step = axes[j][1] - axes[j][0]
+                width = high[j] - low[j]
+                low[j] = axes[j][first] - (width if first == 0 else step)
+                high[j] = axes[j][last] + (width if last == grid - 1 else step)
+            low, high = np.clip(low, lbound, ubound), np.clip(high, lbound, ubound)
+
+        # profile: minimize over the other factor, interpolate where it crosses the threshold
+        threshold = scipy.stats.chi2.ppf(level, 1)
+        self.intervals[name] = []
+        for j in range(2):
+            profile = statistic.min(axis = 1 - j)
+            inside = np.flatnonzero(profile <= threshold)
+            ends = []
+            for end, outside in ((inside[0], inside[0] - 1), (inside[-1], inside[-1] + 1)):
+                if 0 <= outside < grid:
+                    fraction = (threshold - profile[end]) / (profile[outside] - profile[end])
+                    ends.append(axes[j][end] + fraction * (axes[j][outside] - axes[j][end]))
+                else:
+                    ends.append(axes[j][end])
+            self.intervals[name].append(tuple(ends))
+
+        # bands: range of the forecasts within the joint region
+        solution = self.SEIR_ensemble(mesh[region.ravel()], cutoff = cutoff)
+        totals = solution @ aggregate_weights # members x days x aggregates
+        lower, upper = totals.min(axis = 0), totals.max(axis = 0)
+        self.bands[name] = {aggregate: (lower[:, k], upper[:, k]) for k, aggregate in enumerate(aggregates)}
+        return self.intervals[name]
+
+    def peak_ic(self, R, name = 'default', cutoff = 30):
+        # highest IC demand when R is brought to R after cutoff
+        solution = self.SEIR_solution(intervention = [(cutoff,self.factors[name][0]),
+                                                      (self.MAX_RANGE,R/2.2)])
+        return solution.ic_load.max()
+
+    def determine_Rtarget(self, name = 'default', capacity = util.ic_capacity, tolerance = 0.01, R_max = 2):
+        # Highest R on the grid R_max - tolerance, R_max - 2 * tolerance, ... (down to 0) for which
+        # IC demand stays within capacity, None when even R = 0 exceeds it. Peak IC demand increases
+        # with R, so the grid is bisected instead of scanned: about log2(R_max / tolerance) solves
+        # instead of one per step. The number of solves is kept in self.rtarget_solves.
+        self.rtarget_solves = 0
+        def within_capacity(k):
+            self.rtarget_solves += 1
+            return self.peak_ic(R_max - k * tolerance, name) <= capacity
+
+        # smallest k >= 1 with R_max - k * tolerance within capacity
+        lo, hi = 1, int(np.floor(R_max / tolerance + 1e-9))
+        if not within_capacity(hi):
+            return None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if within_capacity(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return round(R_max - lo * tolerance, 10)
+
+    def capacity_table(self, capacities, name = 'default', cutoff = 30, tolerance = 0.01, R_max = 2):
+        # determine_Rtarget for many IC capacities at once: peak IC demand is solved for the whole
+        # R grid (0 up to R_max - tolerance) in one SEIR_ensemble batch, and the increasing
+        # peak-versus-R curve is inverted for every capacity.
+        # Returns a frame with per capacity the highest R within capacity, and the day, date and
+        # IC demand of the peak at that R. Capacities that even R = 0 exceeds are not feasible:
+        # their R and peak columns are NaN (NaT for the date).
+        R_values = np.round(np.arange(int(np.floor(R_max / tolerance + 1e-9))) * tolerance, 10)
+        params = np.column_stack([np.full(len(R_values), self.factors[name][0]), R_values / 2.2])
+        solution = self.SEIR_ensemble(params, cutoff = cutoff)
+        ic = solution @ aggregate_weights[:, list(aggregates).index("IC_total")] # R x days
+        peaks = ic.max(axis = 1)
+
+        # highest grid R with peak <= capacity, -1 when there is none
+        capacities = np.asarray(capacities, dtype=float)
+        pos = np.searchsorted(np.maximum.accumulate(peaks), capacities, side = "right") - 1
+        feasible = pos >= 0
+        pos = np.maximum(pos, 0)
+        peak_day = np.where(feasible, ic[pos].argmax(axis = 1), np.nan)
+        return pd.DataFrame({"capacity": capacities,
+                             "feasible": feasible,
+                             "R": np.where(feasible, R_values[pos], np.nan),
+                             "peak_day": peak_day,
+                             "peak_date": pd.to_datetime(util.model_start, dayfirst = True) + pd.to_timedelta(peak_day, unit = "D"),
+                             "peak_load": np.where(feasible, peaks[pos], np.nan)})
 
     def create_bar(self, Rtarget = 2):
         # create bar chart for question 2
@@ -191,7 +745,19 @@ class forecast_covid19:
         for bar in ["3d_ago_forecast", "previous_forecast", "outlook"]:
             y1.append(self.factors[bar][1]*2.2)
         y1.append(Rtarget)
-        effective_R = go.Bar(y= y1, x = barnames, name = "Reproduction rate (R)", marker_color = barcolors)
+
+        # error bars from profile_likelihood, where available
+        intervals = [(self.intervals["outlook"][0] if "outlook" in self.intervals else None)]
+        for bar in ["3d_ago_forecast", "previous_forecast", "outlook"]:
+            intervals.append(self.intervals[bar][1] if bar in self.intervals else None)
+        intervals.append(None)
+        error_y = None
+        if any(interval is not None for interval in intervals):
+            error_y = dict(type = 'data', symmetric = False, color = '#24292e',
+                           array = [0 if i is None else i[1]*2.2 - y for i, y in zip(intervals, y1)],
+                           arrayminus = [0 if i is None else y - i[0]*2.2 for i, y in zip(intervals, y1)])
+        effective_R = go.Bar(y= y1, x = barnames, name = "Reproduction rate (R)", marker_color = barcolors,
+                             error_y = error_y)
         fig_bar = go.Figure(data = [effective_R])
         fig_bar.update_layout(barmode='stack', uniformtext=dict(mode='show'))
         fig_bar.update_traces(text=y1, texttemplate='%{text:.2f}', textposition='outside', cliponaxis=False)
@@ -203,7 +769,9 @@ class forecast_covid19:
         return fig_bar
 
 
-
-
-
-
+def _fit_job(hospitals, cache_dir, job):
+    # one job of forecast_covid19.fit_many, run in a worker process
+    forecaster = forecast_covid19(hospitals = hospitals, cache_dir = cache_dir)
+    forecaster.fit_REIS(**job)
+    name = job.get("name", "default")
+    return forecaster.factors[name], forecaster.forecasts[name], forecaster.results[name]
@@ -0,0 +1,62 @@
+# Checks of the forecast fits, run with python -m unittest (or pytest)
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import forecast
+
+
+def long_hospitals(days = 175):
+    # hospitalizations.csv extended to more days than SEIR_solution's default horizon of 150,
+    # by continuing the last week's daily admissions
+    hospitals = pd.read_csv("hospitalizations.csv", sep = ";")
+    values = hospitals.iloc[:,1].values.astype(float)
+    daily = np.mean(np.diff(values[-8:]))
+    extra = values[-1] + daily * np.arange(1, days - len(values) + 1)
+    dates = pd.date_range(pd.to_datetime(hospitals.iloc[-1,0], dayfirst = True), periods = len(extra) + 1)[1:]
+    extension = pd.DataFrame({hospitals.columns[0]: dates.strftime("%d/%m/%Y"), hospitals.columns[1]: extra})
+    return pd.concat([hospitals, extension], ignore_index = True)
+
+
+class FitTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.forecaster = forecast.forecast_covid19(hospitals = long_hospitals(), cache_dir = self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors = True)
+
+    def test_gradient_of_loss(self):
+        values = self.forecaster.fit_values()
+        factors = np.array([1.7, 0.3])
+        loss, gradient = self.forecaster.fit_loss(factors, values, gradient = True)
+        self.assertAlmostEqual(loss, self.forecaster.fit_loss(factors, values), delta = 1e-6 * loss)
+        for j in range(2):
+            step = np.eye(2)[j] * 1e-6
+            difference = (self.forecaster.fit_loss(factors + step, values) -
+                          self.forecaster.fit_loss(factors - step, values)) / 2e-6
+            self.assertAlmostEqual(gradient[j], difference, delta = 1e-3 * abs(difference) + 1e-3)
+
+    def test_sensitivity_fit_has_same_optimum(self):
+        factors = {}
+        for sensitivity in (False, True):
+            self.forecaster.fit_REIS(name = "long", sensitivity = sensitivity, warm_start = False, use_cache = False)
+            factors[sensitivity] = self.forecaster.factors["long"]
+        np.testing.assert_allclose(factors[True], factors[False], atol = 1e-3)
+
+    def test_intervals_contain_fit(self):
+        self.forecaster.fit_REIS(name = "long", warm_start = False, use_cache = False)
+        factors = self.forecaster.factors["long"]
+        intervals = self.forecaster.profile_likelihood(name = "long")
+        for factor, (low, high) in zip(factors, intervals):
+            self.assertLessEqual(low, factor + 1e-6)
+            self.assertGreaterEqual(high, factor - 1e-6)
+        lower, upper = self.forecaster.bands["long"]["IC_total"]
+        forecast = self.forecaster.forecasts["long"].ic_load
+        self.assertTrue(np.all(lower <= forecast + 1e-6) and np.all(forecast <= upper + 1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()